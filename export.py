@@ -3,24 +3,42 @@
 # Copyright 2021 Seth Johnson
 # See the top-level LICENSE file for details.
 # SPDX-License-Identifier: Apache-2.0
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta, datetime
-from collections import defaultdict, namedtuple
+from collections import defaultdict
+from dataclasses import dataclass
+from itertools import groupby
+from operator import itemgetter
 from pathlib import Path
 import json
+import logging
 import os
 import os.path
 import shutil
 import sqlite3
+import sys
+import threading
 try:
     from tqdm import tqdm
 except ImportError:
-    tqdm = lambda x: x
+    tqdm = lambda x, **kwargs: x
+try:
+    from orjson import dumps as json_dumpb
+except ImportError:
+    # Match orjson's compact UTF-8 output
+    json_dumpb = lambda x: json.dumps(x, ensure_ascii=False,
+                                      separators=(',', ':')).encode()
 
 
+log = logging.getLogger(__name__)
+
 APPLE_EPOCH = datetime(2001, 1, 1)
 NATIVE_EPOCH = datetime.utcfromtimestamp(0)
 EPOCH_DELTA = APPLE_EPOCH - NATIVE_EPOCH
 NS_TO_SECONDS = 1000000000
+MONTHS = ('JAN', 'FEB', 'MAR', 'APR', 'MAY', 'JUN',
+          'JUL', 'AUG', 'SEP', 'OCT', 'NOV', 'DEC')
+COPY_BUFSIZE = 1 << 20
 
 
 def apple_to_dt(created_date):
@@ -31,6 +49,12 @@ def dt_to_apple(dt):
     return (dt - APPLE_EPOCH).total_seconds()
 
 
+def dt_to_str(dt):
+    # Same as strftime('%Y%b%d %H:%M:%S').upper() but locale-independent
+    return (f"{dt.year}{MONTHS[dt.month - 1]}{dt.day:02d} "
+            f"{dt.hour:02d}:{dt.minute:02d}:{dt.second:02d}")
+
+
 def trim_filename(filename):
     if filename.startswith('~/'):
         filename = filename[2:]
@@ -39,14 +63,75 @@ def trim_filename(filename):
     return filename
 
 
+def fastcopy(src, dst):
+    """Copy the contents of one file to another.
+
+    On Linux the data is transferred in-kernel with sendfile; otherwise it is
+    read into a single reused buffer to avoid allocating a bytes object per
+    chunk. macOS uses shutil.copyfile, which already calls fcopyfile.
+    """
+    if sys.platform == 'darwin':
+        shutil.copyfile(src, dst)
+        return
+
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        if sys.platform.startswith('linux'):
+            infd, outfd = fsrc.fileno(), fdst.fileno()
+            offset = 0
+            try:
+                while True:
+                    sent = os.sendfile(outfd, infd, offset, 1 << 30)
+                    if not sent:
+                        return
+                    offset += sent
+            except OSError:
+                # Only fall back if the filesystem rejected sendfile outright
+                if offset:
+                    raise
+
+        mv = memoryview(bytearray(COPY_BUFSIZE))
+        while True:
+            n = fsrc.readinto(mv)
+            if not n:
+                break
+            fdst.write(mv[:n])
+
+
 class ConnectedDatabase:
+    # Tuning for large read-only scans: memory-map the file, and keep hot
+    # pages and temporary sort tables in memory
+    PRAGMAS = [
+        "PRAGMA temp_store=MEMORY",
+        "PRAGMA mmap_size=268435456",
+        "PRAGMA cache_size=-65536",
+    ]
+    # Number of rows per fetchmany call
+    ARRAYSIZE = 1024
+
     def __init__(self, filename):
         if not filename.exists():
             raise RuntimeError(f"No database file exists at {filename}")
 
-        self.connection = sqlite3.connect(f"file:{filename!s}?mode=ro", uri=True)
+        # The backup is never modified while we read it, so opening it as
+        # immutable skips file locking and the WAL index entirely
+        try:
+            self.connection = self._connect(filename, "mode=ro&immutable=1")
+        except sqlite3.OperationalError:
+            self.connection = self._connect(filename, "mode=ro")
         self.cursor = self.connection.cursor()
         self._col_names = {}
+        # Serialize any queries made from export worker threads
+        self._lock = threading.Lock()
+
+    def _connect(self, filename, mode):
+        # A single connection is shared by all export threads (rather than
+        # one per thread), so there is only ever one page cache per file
+        # and no need for SQLite's shared-cache mode
+        connection = sqlite3.connect(f"file:{filename!s}?{mode}", uri=True,
+                                     check_same_thread=False)
+        for pragma in self.PRAGMAS:
+            connection.execute(pragma)
+        return connection
 
     def col_names(self, table):
         try:
@@ -60,41 +145,114 @@ class ConnectedDatabase:
 
     def nice_row(self, table, colname, value):
         # Question-mark selection won't substitute into table/colname
-        rows = list(self.cursor.execute(
-            f'SELECT * FROM {table} WHERE {colname} = {value}'))
-        if len(rows) != 1:
-            raise TypeError(f"Expected 1 row but got {rows}")
-        return dict(zip(self.col_names(table), rows[0]))
+        cursor = self.cursor.execute(
+            f'SELECT * FROM {table} WHERE {colname} = ?', (value,))
+        row = cursor.fetchone()
+        if row is None or cursor.fetchone() is not None:
+            raise TypeError(f"Expected 1 row for {colname} = {value}")
+        return dict(zip(self.col_names(table), row))
 
     def execute(self, *args):
         return self.cursor.execute(*args)
 
-
-Chat = namedtuple('Chat', ['id', 'guid', 'identifier'])
-Message = namedtuple('Message', ['id', 'date', 'who', 'value'])
-Attachment = namedtuple('Attachment', ['path', 'uti', 'name', 'date'])
+    def fetch_chunks(self, *args):
+        """Execute a query on a separate cursor and yield lists of rows.
+        """
+        cursor = self.connection.cursor()
+        cursor.arraysize = self.ARRAYSIZE
+        cursor.execute(*args)
+        while True:
+            rows = cursor.fetchmany()
+            if not rows:
+                break
+            yield rows
+
+
+@dataclass
+class Chat:
+    __slots__ = ('id', 'guid', 'identifier')
+    id: int
+    guid: str
+    identifier: str
+
+
+@dataclass
+class Message:
+    __slots__ = ('id', 'date', 'who', 'value')
+    id: int
+    date: datetime
+    who: str
+    value: object
+
+
+@dataclass
+class Attachment:
+    __slots__ = ('path', 'uti', 'name', 'date')
+    path: str
+    uti: str
+    name: str
+    date: int
 
 
 class Manifest(ConnectedDatabase):
     def __init__(self, root):
         self.root = Path(root)
         super().__init__(self.root / "manifest.db")
+        self._paths = {}
+
+    def prefetch_paths(self, filenames, chunk_size=500):
+        """Look up backup paths for many files with a few batched queries.
+        """
+        filenames = list(filenames)
+        for i in range(0, len(filenames), chunk_size):
+            chunk = filenames[i:i + chunk_size]
+            placeholders = ",".join("?" * len(chunk))
+            rows = self.execute(
+                "select relativePath, fileID from Files "
+                f"where relativePath in ({placeholders})", chunk)
+            found = {}
+            for (relpath, fid) in rows:
+                if relpath in found:
+                    raise TypeError(
+                        f"Unexpected number of results for {relpath}")
+                found[relpath] = self.root / fid[:2] / fid
+            # Record misses as None so get_path doesn't query them again
+            for filename in chunk:
+                self._paths[filename] = found.get(filename)
 
     def get_path(self, filename):
-        fileids = list(self.cursor.execute(
-            "select fileID from Files where relativePath == ?",
-            (str(filename),)))
-        if len(fileids) > 1:
-            raise TypeError(f"Unexpected number of results: got {fileids}")
-        elif not fileids:
+        filename = str(filename)
+        try:
+            path = self._paths[filename]
+        except KeyError:
+            path = self._query_path(filename)
+            # Cache misses too, since many messages can share a file
+            self._paths[filename] = path
+        if path is None:
             raise FileNotFoundError(f"Missing file from manifest: {filename}")
-        fid = fileids[0][0]
+        return path
+
+    def _query_path(self, filename):
+        with self._lock:
+            cursor = self.cursor.execute(
+                "select fileID from Files where relativePath == ?",
+                (filename,))
+            row = cursor.fetchone()
+            extra = cursor.fetchone()
+        if row is None:
+            return None
+        elif extra is not None:
+            raise TypeError(f"Unexpected number of results for {filename}")
+        fid = row[0]
         return self.root / fid[:2] / fid
 
 
 class Messages(ConnectedDatabase):
-    def __init__(self, manifest):
+    def __init__(self, manifest, *, min_date=None, max_date=None):
         """Initialize from a manifest object to load the SMS database.
+
+        All messages (optionally restricted to the given date range) and
+        attachments are loaded up front and grouped by chat ID.
         """
         filename = manifest.get_path('Library/SMS/sms.db')
         if not filename.exists():
@@ -107,88 +265,130 @@ class Messages(ConnectedDatabase):
         # Retain the method for getting filenames
         self.get_backup_filename = manifest.get_path
 
-    def get_enumerated_chat_names(self):
-        """Return chat ID and phone numbers for each chat (may be duplicates).
-        """
-        rows = self.execute("SELECT ROWID, guid, chat_identifier FROM chat")
-        for r in rows:
-            yield Chat(*r)
+        self._load_all(min_date=min_date, max_date=max_date)
+        manifest.prefetch_paths({
+            att.path
+            for atts in self._atts_by_chat.values()
+            for msg_atts in atts.values()
+            for att in msg_atts
+        })
 
-    def get_attachments(self, chat_id):
-        """Return all IDs, handles, date stamps, and text from a given chat ID.
+    def _load_all(self, *, min_date=None, max_date=None):
+        """Load all attachments and messages with a single query each.
         """
         rows = self.execute(
-            "SELECT maj.message_id, "
+            "SELECT cmj.chat_id, maj.message_id, "
             "a.filename, a.uti, a.transfer_name, a.created_date "
-            "FROM attachment a "
-            "LEFT JOIN message_attachment_join maj "
-            "ON a.ROWID = maj.attachment_id "
-            "LEFT JOIN chat_message_join cmj "
+            "FROM chat_message_join cmj "
+            "INNER JOIN message_attachment_join maj "
             "ON maj.message_id = cmj.message_id "
-            "WHERE cmj.chat_id = ?", (chat_id,)
+            "INNER JOIN attachment a "
+            "ON a.ROWID = maj.attachment_id "
+            "ORDER BY cmj.chat_id, maj.message_id, a.ROWID"
         )
-        attachments = defaultdict(list)
-        for (mid, path, uti, name, date) in rows:
-            path = trim_filename(path)
-            if name is None:
-                name = os.path.basename(path)
-            attachments[mid].append(Attachment(path, uti, name, date))
-        return attachments
-
-    def get_messages(self, chat_id, *, min_date=None, max_date=None):
-        """Return all IDs, handles, date stamps, and text from a given chat ID.
-        """
-        attachments = self.get_attachments(chat_id)
+        attachments = defaultdict(dict)
+        for ((chat_id, mid), group) in groupby(rows, key=itemgetter(0, 1)):
+            atts = []
+            for (_, _, path, uti, name, date) in group:
+                path = trim_filename(path)
+                if name is None:
+                    name = os.path.basename(path)
+                atts.append(Attachment(path, uti, name, date))
+            attachments[chat_id][mid] = tuple(atts)
+        self._atts_by_chat = attachments
 
         date_restrict = ""
-        min_date = dt_to_apple(min_date) * NS_TO_SECONDS if min_date else None
-        max_date = dt_to_apple(max_date) * NS_TO_SECONDS if max_date else None
+        date_params = ()
+        if min_date:
+            min_date = int(dt_to_apple(min_date) * NS_TO_SECONDS)
+        if max_date:
+            max_date = int(dt_to_apple(max_date) * NS_TO_SECONDS)
         if min_date and max_date:
-            date_restrict = f"AND m.date BETWEEN {min_date} AND {max_date}"
+            date_restrict = "WHERE m.date BETWEEN ? AND ?"
+            date_params = (min_date, max_date)
         elif min_date:
-            date_restrict = f"AND m.date >= {min_date}"
+            date_restrict = "WHERE m.date >= ?"
+            date_params = (min_date,)
         elif max_date:
-            date_restrict = f"AND m.date < {max_date}"
+            date_restrict = "WHERE m.date < ?"
+            date_params = (max_date,)
 
-        rows = self.execute(
-            "SELECT ROWID, date, handle_id, account, is_from_me, "
+        # Use a separate cursor since error diagnostics below reuse ours
+        chunks = self.fetch_chunks(
+            "SELECT cmj.chat_id, ROWID, date, handle_id, account, is_from_me, "
             "text, cache_has_attachments "
-            "FROM message m "
-            "LEFT JOIN chat_message_join cmj "
+            "FROM chat_message_join cmj "
+            "INNER JOIN message m "
             "ON m.ROWID = cmj.message_id "
-            "WHERE cmj.chat_id = ? "
             + date_restrict,
-            (chat_id,)
+            date_params
         )
 
-        for (rowid, date, handle_id, account, is_from_me, content,
-                has_attachments) in rows:
-            date = apple_to_dt(date // NS_TO_SECONDS) # convert from ns
-            if is_from_me:
-                if account:
-                    sender = account.partition(':')[-1] or account
-                else:
-                    sender = None
-            elif handle_id == 0:
-                sender = "<unknown>"
-            else:
+        # Senders repeat heavily, so resolve each distinct one only once
+        senders = {}
+        messages = defaultdict(list)
+        for rows in chunks:
+            for (chat_id, rowid, date, handle_id, account, is_from_me,
+                    content, has_attachments) in rows:
+                date = apple_to_dt(date // NS_TO_SECONDS) # convert from ns
+                key = (True, account) if is_from_me else (False, handle_id)
                 try:
-                    sender = self._handles[handle_id]
+                    sender = senders[key]
                 except KeyError:
-                    print(f"Failed handle id {handle_id} in message {rowid}")
-                    print(self.nice_row('message', 'ROWID', rowid))
-                    sender = handle_id
-            if has_attachments:
-                content = attachments[rowid] + [content]
-            yield Message(rowid, date, sender, content)
+                    sender = senders[key] = self._get_sender(rowid, *key)
+                if has_attachments:
+                    msg_atts = attachments.get(chat_id, {}).get(rowid, ())
+                    content = msg_atts + (content,)
+                messages[chat_id].append(Message(rowid, date, sender, content))
+        self._msgs_by_chat = messages
+
+    def _get_sender(self, rowid, is_from_me, account_or_handle):
+        """Return a display name for the sender of a message.
+        """
+        if is_from_me:
+            account = account_or_handle
+            if account:
+                return account.partition(':')[-1] or account
+            return None
+
+        handle_id = account_or_handle
+        if handle_id == 0:
+            return "<unknown>"
+        try:
+            return self._handles[handle_id]
+        except KeyError:
+            log.warning("Failed handle id %s in message %s", handle_id, rowid)
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("%s", self.nice_row('message', 'ROWID', rowid))
+            return handle_id
+
+    def get_enumerated_chat_names(self):
+        """Return chat ID and phone numbers for each chat (may be duplicates).
+        """
+        rows = self.execute("SELECT ROWID, guid, chat_identifier FROM chat")
+        for r in rows:
+            yield Chat(*r)
+
+    def get_attachments(self, chat_id):
+        """Return attachments from a given chat ID, keyed by message ID.
+        """
+        return self._atts_by_chat.get(chat_id, {})
+
+    def get_messages(self, chat_id):
+        """Return all IDs, handles, date stamps, and text from a given chat ID.
+        """
+        return self._msgs_by_chat.get(chat_id, [])
 
     def copy_attachment(self, msg_id, att, att_root):
+        # Use plain strings here: this runs once per attachment
         new_name = f'{msg_id}-{att.name}'
-        dst = att_root / new_name
+        dst = os.path.join(att_root, new_name)
         try:
-            shutil.copy(self.get_backup_filename(att.path), dst)
+            src = os.fspath(self.get_backup_filename(att.path))
+            fastcopy(src, dst)
         except FileNotFoundError as e:
-            print(f"Failed to copy attachment {att} in message {msg_id}:", e)
+            log.warning("Failed to copy attachment %s in message %s: %s",
+                        att, msg_id, e)
             return None
 
         ctime = (EPOCH_DELTA + timedelta(seconds=att.date)).total_seconds()
@@ -196,39 +396,48 @@ class Messages(ConnectedDatabase):
         return new_name
 
     def export_chat(self, chat, root_path):
-        dst_path = root_path / f'{chat.identifier}'
-        att_root = None
-        result = []
-        for msg in self.get_messages(chat.id):
-            msg = msg._asdict()
-            msg['date'] = msg['date'].strftime('%Y%b%d %H:%M:%S').upper()
-            val = msg['value']
-            if isinstance(val, list):
-                # Copy and convert attachments
-                newval = []
-                for att in val:
-                    if not isinstance(att, Attachment):
-                        # Text payload
-                        newval.append(att)
-                        continue
-                    if att_root is None:
-                        # Lazy creation of attachments dir
-                        att_root = dst_path / 'attachments'
-                        att_root.mkdir(parents=True, exist_ok=True)
-                    new_name = self.copy_attachment(msg['id'], att, att_root)
-                    newval.append({'name': new_name,
-                                   'uti': att.uti,
-                                   'orig': att.path})
-                msg['value'] = newval
-            result.append(msg)
-        if not result:
+        messages = self.get_messages(chat.id)
+        if not messages:
             # Old recipient with no new chats
             # print(f"No messages found for chat {chat.identifier}")
             return
+
+        dst_path = root_path / f'{chat.identifier}'
+        att_root = None
         guid = chat.guid.replace(';', '')
         dst_path.mkdir(exist_ok=True)
-        with open(dst_path / f'messages-{guid}.json', 'w') as f:
-            json.dump(result, f, indent=1)
+        # Write one message per line rather than building the whole list
+        with open(dst_path / f'messages-{guid}.json', 'wb',
+                  buffering=1 << 20) as f:
+            f.write(b'[\n')
+            for i, msg in enumerate(messages):
+                msg = {'id': msg.id,
+                       'date': dt_to_str(msg.date),
+                       'who': msg.who,
+                       'value': msg.value}
+                val = msg['value']
+                if isinstance(val, tuple):
+                    # Copy and convert attachments
+                    newval = []
+                    for att in val:
+                        if not isinstance(att, Attachment):
+                            # Text payload
+                            newval.append(att)
+                            continue
+                        if att_root is None:
+                            # Lazy creation of attachments dir
+                            att_root = os.fspath(dst_path / 'attachments')
+                            os.makedirs(att_root, exist_ok=True)
+                        new_name = self.copy_attachment(msg['id'], att,
+                                                        att_root)
+                        newval.append({'name': new_name,
+                                       'uti': att.uti,
+                                       'orig': att.path})
+                    msg['value'] = newval
+                if i:
+                    f.write(b',\n')
+                f.write(json_dumpb(msg))
+            f.write(b'\n]\n')
 
 def main(source, destination):
     """Load a manifest from your backup directory (should look like
@@ -240,9 +449,11 @@ def main(source, destination):
     manifest = Manifest(Path(source))
     msg = Messages(manifest)
     chats = list(msg.get_enumerated_chat_names())
-    for c in tqdm(chats):
-        msg.export_chat(c, destination)
+    # Messages are already loaded, so workers only copy files and write JSON
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        results = executor.map(lambda c: msg.export_chat(c, destination),
+                               chats)
+        list(tqdm(results, total=len(chats)))
 
 if __name__ == '__main__':
-    import sys
     main(*sys.argv[1:])